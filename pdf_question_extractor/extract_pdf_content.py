@@ -1,12 +1,11 @@
 import fitz  # PyMuPDF for reading PDFs
 import os
+import gc
 import json
-import hashlib
 import re
-from PIL import Image
-from io import BytesIO
-from typing import List, Dict, Union
-import subprocess
+from typing import List, Dict, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from generate_questions_from_captions import build_questions, save_captions
 
 # Set file paths and constants
 PDF_PATH = "IMO class 1 Maths Olympiad Sample Paper 1 for the year 2024-25.pdf"
@@ -15,129 +14,179 @@ OUTPUT_DIR = "output"
 IMAGE_DIR = os.path.join(OUTPUT_DIR, "images")
 JSON_OUTPUT = os.path.join(OUTPUT_DIR, "extracted_content.json")
 VALID_IMAGE_EXTS = ['png', 'jpg', 'jpeg', 'jpe']
+DROP_CACHE_EVERY = 16  # Pages between MuPDF store flushes
+
+# Pre-compiled regex patterns
+ANS_RE = re.compile(r'Ans\.?\s*\[?[A-D]\]?', re.IGNORECASE)
+PAGE_RE = re.compile(r'---page\d+---')
+PAGE_NUM_RE = re.compile(r'---page(\d+)---')
+QITER_RE = re.compile(r'^(\d+)\.\s(.*?)(?=^\d+\.\s|\Z)', re.MULTILINE | re.DOTALL)
+OPT_FINDITER_RE = re.compile(r'\[([A-D])\]([^\[\]\n]*)[^\[\]]*')
+IMG_HINT_RE = re.compile(r'\d+\s*[=≠<>]\s*\d+|_\s*_\s*_|see (?:figure|image|diagram)|below\s*:?$', re.IGNORECASE)
 
 # Create image output directory if it doesn't exist
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+def _get_rgb_samples(pm: fitz.Pixmap) -> bytes:
+    # Return the pixmap's pixels as RGB samples without alpha (used for comparison).
+    # A copy is returned since a converted pixmap is freed when this function returns.
+    if pm.alpha:
+        pm = fitz.Pixmap(pm, 0)
+    if pm.n != 3:
+        pm = fitz.Pixmap(fitz.csRGB, pm)
+    return pm.samples
+
+def _is_logo(doc: fitz.Document, img: tuple, logo: Optional[Tuple[int, int, bytes]]) -> bool:
+    # Compare an image against the Vedantu logo, checking dimensions before decoding
+    if not logo:
+        return False
+    xref, width, height = img[0], img[2], img[3]
+    logo_width, logo_height, logo_samples = logo
+    if width != logo_width or height != logo_height:
+        return False
+    return _get_rgb_samples(fitz.Pixmap(doc, xref)) == logo_samples
+
+def _save_image(image_bytes: bytes, path: str) -> bool:
+    # Save image to disk at given path
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(image_bytes)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        return True
+    except OSError:
+        return False
+
+def _is_cached_logo(doc: fitz.Document, img: tuple, logo: Optional[Tuple[int, int, bytes]],
+                    seen_xref: Dict[int, bool]) -> bool:
+    # Check whether an image is the Vedantu logo, caching only the verdict per xref
+    # so images reused across pages are compared once without holding their bytes.
+    xref = img[0]
+    if xref not in seen_xref:
+        seen_xref[xref] = _is_logo(doc, img, logo)
+    return seen_xref[xref]
+
+def _load_image(doc: fitz.Document, img: tuple, logo: Optional[Tuple[int, int, bytes]],
+                seen_xref: Dict[int, bool]) -> Optional[Tuple[bytes, str]]:
+    # Return (image bytes, extension) for an image, or None if it's the Vedantu logo
+    if _is_cached_logo(doc, img, logo, seen_xref):
+        return None
+    base_image = doc.extract_image(img[0])
+    return base_image["image"], base_image["ext"].lower()
+
+def _should_skip_page(text: str, image_infos: list, doc: fitz.Document, logo: Optional[Tuple[int, int, bytes]],
+                      seen_xref: Dict[int, bool]) -> bool:
+    # Skip page if it's blank except Vedantu logo
+    if not text and len(image_infos) == 1 and logo:
+        return _is_cached_logo(doc, image_infos[0], logo, seen_xref)
+    return False
+
+def _process_pages(pdf_path: str, page_numbers: range, logo: Optional[Tuple[int, int, bytes]]) -> List[Tuple[Optional[str], List[Dict]]]:
+    # Extract text and save valid images for a range of pages (runs in a worker process).
+    # Text is None for pages that should be skipped.
+    seen_xref: Dict[int, bool] = {}
+    results = []
+    with fitz.open(pdf_path) as doc:
+        for count, page_number in enumerate(page_numbers, 1):
+            page = doc.load_page(page_number)
+            image_infos = page.get_images(full=True)
+            text = page.get_text().strip()
+            page = None  # Release the page's parsed resources
+
+            # Periodically empty MuPDF's resource store to cap memory use
+            if count % DROP_CACHE_EVERY == 0:
+                fitz.TOOLS.store_shrink(100)
+                gc.collect()
+
+            if _should_skip_page(text, image_infos, doc, logo, seen_xref):
+                results.append((None, []))
+                continue
+
+            # Extract and save valid images from the page
+            page_images = []
+            for img_index, img in enumerate(image_infos, 1):
+                image = _load_image(doc, img, logo, seen_xref)
+                if image is None:
+                    continue
+                image_bytes, ext = image
+                if ext not in VALID_IMAGE_EXTS:
+                    continue
+                filename = f"page{page_number+1}_image{img_index}.{ext}"
+                path = os.path.join(IMAGE_DIR, filename)
+                if _save_image(image_bytes, path):
+                    page_images.append({
+                        "page": page_number + 1,
+                        "image": path
+                    })
+            results.append((text, page_images))
+    return results
+
 class PDFExtractor:
     def __init__(self):
-        self.vedantu_logo_hash = None
-        self._load_vedantu_logo()  # Precompute Vedantu logo hash for skipping
+        self.vedantu_logo = None
+        self._load_vedantu_logo()  # Precompute Vedantu logo pixels for skipping
 
     def _load_vedantu_logo(self):
         if os.path.exists(VEDANTU_LOGO_PATH):
-            with open(VEDANTU_LOGO_PATH, "rb") as logo_file:
-                logo_bytes = logo_file.read()
-            self.vedantu_logo_hash = self._get_image_hash(logo_bytes)
-
-    def _get_image_hash(self, image_data: bytes) -> str:
-        # Return MD5 hash of the image bytes (used for comparison)
-        with Image.open(BytesIO(image_data)) as img:
-            img = img.convert("RGB")
-            return hashlib.md5(img.tobytes()).hexdigest()
-
-    def _save_image(self, image_bytes: bytes, path: str) -> bool:
-        # Save image to disk at given path
-        try:
-            with open(path, "wb") as f:
-                f.write(image_bytes)
-            return True
-        except:
-            return False
+            pm = fitz.Pixmap(VEDANTU_LOGO_PATH)
+            self.vedantu_logo = (pm.width, pm.height, _get_rgb_samples(pm))
 
     def _clean_question_text(self, text: str) -> str:
         # Remove unwanted patterns like "Ans. [A]" and page tags
-        text = re.sub(r'Ans\.?\s*\[?[A-D]\]?', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'---page\d+---', '', text)
+        text = ANS_RE.sub('', text)
+        text = PAGE_RE.sub('', text)
         return ' '.join(text.split()).strip()
 
     def _extract_options(self, question_text: str) -> List[Dict[str, str]]:
-        # Extract options formatted like [A] Option Text
-        options = []
-        option_parts = re.split(r'(\[[A-D]\][^\[\]]*)', question_text)
-        for part in option_parts:
-            if not part.strip():
-                continue
-            match = re.match(r'\[([A-D])\](.*)', part.strip())
-            if match:
-                label = match.group(1)
-                text = match.group(2).strip()
-                if text:
-                    options.append({"label": label, "text": text})
-        return options
-
-    def _should_skip_page(self, text: str, image_infos: list, doc: fitz.Document) -> bool:
-        # Skip page if it's blank except Vedantu logo
-        if not text and len(image_infos) == 1 and self.vedantu_logo_hash:
-            xref = image_infos[0][0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            return self._get_image_hash(image_bytes) == self.vedantu_logo_hash
-        return False
+        # Extract options formatted like [A] Option Text (text runs to the end of its line)
+        return [
+            {"label": m.group(1), "text": m.group(2).strip()}
+            for m in OPT_FINDITER_RE.finditer(question_text)
+            if m.group(2).strip()
+        ]
 
     def _is_question_with_image(self, text: str) -> bool:
         # Check if question likely refers to a diagram/image
-        patterns = [
-            r'\d+\s*[=≠<>]\s*\d+',
-            r'_\s*_\s*_',
-            r'see (figure|image|diagram)',
-            r'below\s*:?$'
-        ]
-        return any(re.search(p, text, re.IGNORECASE) for p in patterns)
+        return IMG_HINT_RE.search(text) is not None
 
     def extract_content(self) -> List[Dict[str, Union[str, List, Dict]]]:
-        doc = fitz.open(PDF_PATH)
-        all_text = ""
+        with fitz.open(PDF_PATH) as doc:
+            page_count = len(doc)
+        chunks = []
         all_images = []
 
-        # Extract and save valid images from each page
-        for page_number in range(len(doc)):
-            page = doc.load_page(page_number)
-            image_infos = page.get_images(full=True)
-            for img_index, img in enumerate(image_infos, 1):
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                ext = base_image["ext"].lower()
-                if ext not in VALID_IMAGE_EXTS:
-                    continue
-                if self.vedantu_logo_hash and self._get_image_hash(image_bytes) == self.vedantu_logo_hash:
-                    continue
-                filename = f"page{page_number+1}_image{img_index}.{ext}"
-                path = os.path.join(IMAGE_DIR, filename)
-                if self._save_image(image_bytes, path):
-                    all_images.append({
-                        "page": page_number + 1,
-                        "image": path
-                    })
+        # Split pages into contiguous ranges, one per worker process
+        num_workers = min(os.cpu_count() or 1, 4)
+        step = max(1, -(-page_count // num_workers))
+        page_ranges = [range(start, min(start + step, page_count)) for start in range(0, page_count, step)]
 
-        # Extract text from each page
-        for page_number in range(len(doc)):
-            page = doc.load_page(page_number)
-            text = page.get_text().strip()
-            if self._should_skip_page(text, page.get_images(full=True), doc):
-                continue
-            all_text += f"\n---page{page_number + 1}---\n{text}"
+        # Extract text and images in parallel, then collect results in page order
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_process_pages, PDF_PATH, r, self.vedantu_logo) for r in page_ranges]
+            page_results = [result for future in futures for result in future.result()]
 
-        # Split text into individual questions
-        question_pattern = r'(?=\n\d+\.\s|\A\d+\.\s)'
-        raw_questions = re.split(question_pattern, all_text)
-        raw_questions = [q.strip() for q in raw_questions if re.match(r'^\d+\.\s', q.strip())]
+        for page_number, (text, page_images) in enumerate(page_results):
+            all_images.extend(page_images)
+            if text is None:
+                continue
+            chunks.append(f"\n---page{page_number + 1}---\n{text}")
+        all_text = "".join(chunks)
 
         questions_data = []
         image_index = 0
 
-        # Process each question
-        for q_text in raw_questions:
+        # Split text into individual questions and process each one
+        for question_match in QITER_RE.finditer(all_text):
+            q_text = question_match.group(0).strip()
             if q_text.upper().startswith("CLASS") or "SECTION" in q_text.upper():
                 continue
 
-            question_num_match = re.match(r'^(\d+)\.', q_text)
-            if not question_num_match:
-                continue
-
             clean_text = self._clean_question_text(q_text)
-            current_page = int(re.search(r'---page(\d+)---', q_text).group(1)) if re.search(r'---page(\d+)---', q_text) else None
+            page_match = PAGE_NUM_RE.search(q_text)
+            current_page = int(page_match.group(1)) if page_match else None
 
             question_images = []
             if image_index < len(all_images):
@@ -183,6 +232,11 @@ if __name__ == "__main__":
     data = extractor.extract_content()
     extractor.save_to_json(data)
 
-    # Run additional post-processing scripts
-    subprocess.run(["python", "generate_image_captions.py"])
-    subprocess.run(["python", "generate_questions_from_captions.py"])
+    # Run post-processing in-process; transformers is only imported when there are images
+    if os.listdir(IMAGE_DIR):
+        from generate_image_captions import caption_all
+        captions = caption_all(IMAGE_DIR)
+    else:
+        captions = {}
+        save_captions(captions)
+    build_questions(captions)
@@ -1,35 +1,173 @@
 from transformers import VisionEncoderDecoderModel, ViTImageProcessor, AutoTokenizer
+from transformers.modeling_outputs import BaseModelOutput
 from PIL import Image
 import os
-import json
+import hashlib
+import torch
+from torch.utils.data import DataLoader, Dataset
+from generate_questions_from_captions import save_captions
+
+MODEL_NAME = "nlpconnect/vit-gpt2-image-captioning"
+BATCH_SIZE = 16
+NUM_WORKERS = 4
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+# Cached features are stored per checkpoint so switching models never reuses old encoder outputs
+FEATURE_CACHE_DIR = os.path.join("output/.feat_cache", MODEL_NAME.replace("/", "--"))
+
+# Check for native CPU bf16 matmuls (AVX512-BF16 or AMX); otherwise bf16 is emulated
+def cpu_supports_bf16():
+    checks = [
+        getattr(torch.cpu, "_is_avx512_bf16_supported", None),
+        getattr(torch.cpu, "_is_amx_tile_supported", None),
+    ]
+    return any(check() for check in checks if check)
 
 # Load model and tokenizer
-model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-processor = ViTImageProcessor.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-tokenizer = AutoTokenizer.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-
-# Caption generation function (fixed: beam search disabled)
-def generate_caption(image_path):
-    image = Image.open(image_path).convert("RGB")
-    pixel_values = processor(images=image, return_tensors="pt").pixel_values
-    output_ids = model.generate(pixel_values, max_length=16, num_beams=1)  # beam search disabled
-    caption = tokenizer.decode(output_ids[0], skip_special_tokens=True)
-    return caption.strip()
-
-# Directory containing images
-image_dir = "output/images"
-captions = {}
-
-# Process all images in the directory
-for filename in os.listdir(image_dir):
-    if filename.lower().endswith((".png", ".jpg", ".jpeg")):
-        path = os.path.join(image_dir, filename)
-        print(f"🔍 Generating caption for: {filename}")
-        captions[filename] = generate_caption(path)
-
-# Save captions to JSON
-output_path = "output/image_captions.json"
-with open(output_path, "w") as f:
-    json.dump(captions, f, indent=2)
-
-print(f"✅ Captions saved to {output_path}")
+def load_model():
+    # Use bfloat16 weights, falling back to float16 on GPUs and float32 on CPUs without bf16 support
+    dtype = torch.bfloat16
+    if torch.cuda.is_available():
+        if not torch.cuda.is_bf16_supported():
+            dtype = torch.float16
+    elif not cpu_supports_bf16():
+        dtype = torch.float32
+    model = VisionEncoderDecoderModel.from_pretrained(MODEL_NAME, torch_dtype=dtype).eval()
+    processor = ViTImageProcessor.from_pretrained(MODEL_NAME)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+
+    # Run on GPU when available
+    if torch.cuda.is_available():
+        model = model.to("cuda")
+
+    # Use a fixed-shape KV cache and compile the forward pass for decoding
+    model.generation_config.cache_implementation = "static"
+    model.generation_config.max_length = 16
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+    return model, processor, tokenizer
+
+# Open an image as RGB, skipping the conversion copy when it's already RGB
+def load_image(path):
+    image = Image.open(path)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+# Encode preprocessed images into ViT features (the expensive part of captioning)
+def encode(model, pixel_values):
+    pixel_values = pixel_values.to(model.device, dtype=model.dtype, non_blocking=True)
+    with torch.inference_mode():
+        return model.get_encoder()(pixel_values).last_hidden_state
+
+# Decode captions from ViT features (beam search disabled)
+def decode(model, tokenizer, hidden_states):
+    encoder_outputs = BaseModelOutput(last_hidden_state=hidden_states)
+    with torch.inference_mode():
+        output_ids = model.generate(encoder_outputs=encoder_outputs, max_length=16, num_beams=1, use_cache=True)
+    captions = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+    return [caption.strip() for caption in captions]
+
+# Run decode() on zero encoder states so the compiled graph is specialised before real use
+def warm_up(model, tokenizer, batch_sizes):
+    encoder_config = model.config.encoder
+    seq_len = (encoder_config.image_size // encoder_config.patch_size) ** 2 + 1
+    for batch_size in batch_sizes:
+        dummy = torch.zeros(
+            batch_size, seq_len, encoder_config.hidden_size,
+            device=model.device, dtype=model.dtype
+        )
+        for _ in range(3):
+            decode(model, tokenizer, dummy)
+
+# Load cached encoder features, treating a missing or unreadable entry as a miss
+def load_cached_features(cache_path, device):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        return torch.load(cache_path, map_location=device)
+    except Exception:
+        return None
+
+# Save encoder features atomically so an interrupted run never leaves a truncated entry
+def save_cached_features(hidden, cache_path):
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    torch.save(hidden, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+# Cache file for an image's encoder features, keyed by the MD5 of its bytes
+def feature_cache_path(path):
+    with open(path, "rb") as f:
+        h = hashlib.md5(f.read()).hexdigest()
+    return os.path.join(FEATURE_CACHE_DIR, f"{h}.pt")
+
+# Dataset of image batches, prepared in DataLoader worker processes: each item holds
+# cached features for cache hits and preprocessed pixel values for misses
+class ImgDS(Dataset):
+    def __init__(self, paths, processor):
+        self.batches = [paths[i:i + BATCH_SIZE] for i in range(0, len(paths), BATCH_SIZE)]
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        cached = {}
+        misses = []
+        images = []
+        for i, path in enumerate(self.batches[index]):
+            cache_path = feature_cache_path(path)
+            hidden = load_cached_features(cache_path, "cpu")
+            if hidden is not None:
+                cached[i] = hidden
+            else:
+                misses.append((i, cache_path))
+                images.append(load_image(path))
+        pixel_values = self.processor(images=images, return_tensors="pt").pixel_values if images else None
+        return {"cached": cached, "misses": misses, "pixel_values": pixel_values}
+
+# Assemble encoder features for one prepared batch, encoding and caching the misses
+def batch_features(model, item):
+    features = {i: hidden.to(model.device, non_blocking=True) for i, hidden in item["cached"].items()}
+    if item["misses"]:
+        for (i, cache_path), hidden in zip(item["misses"], encode(model, item["pixel_values"])):
+            # Clone so only this row is saved, not the whole batch storage it views
+            save_cached_features(hidden.cpu().clone(), cache_path)
+            features[i] = hidden
+    return torch.stack([features[i].to(model.dtype) for i in range(len(features))])
+
+# Caption every image in a directory and save the captions to JSON
+def caption_all(image_dir):
+    captions = {}
+
+    # Collect all images in the directory
+    filenames = [f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTS)]
+    if not filenames:
+        save_captions(captions)
+        return captions
+
+    model, processor, tokenizer = load_model()
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+
+    # Warm up the compiled graph for every batch shape the decode loop will see
+    batch_sizes = {min(BATCH_SIZE, len(filenames)), len(filenames) % BATCH_SIZE} - {0}
+    warm_up(model, tokenizer, batch_sizes)
+
+    # Prepare the next batches in the background while the current one is encoded and decoded
+    paths = [os.path.join(image_dir, f) for f in filenames]
+    dataset = ImgDS(paths, processor)
+    loader = DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=min(NUM_WORKERS, os.cpu_count() or 1, len(dataset)),
+        pin_memory=torch.cuda.is_available()
+    )
+    for i, item in zip(range(0, len(filenames), BATCH_SIZE), loader):
+        batch = filenames[i:i + BATCH_SIZE]
+        print(f"🔍 Generating captions for: {', '.join(batch)}")
+        hidden_states = batch_features(model, item)
+        captions.update(zip(batch, decode(model, tokenizer, hidden_states)))
+
+    save_captions(captions)
+    return captions
+
+if __name__ == "__main__":
+    caption_all("output/images")
@@ -1,25 +1,49 @@
 import json
 
-with open("output/image_captions.json") as f:
-    captions = json.load(f)
-
-questions = []
-
-for filename, caption in captions.items():
-    question = {
-        "question": f"What does this image likely represent?",
-        "options": [
-            {"label": "A", "text": caption, "image": None},
-            {"label": "B", "text": "A random object", "image": None},
-            {"label": "C", "text": "An unrelated thing", "image": None},
-            {"label": "D", "text": "None of the above", "image": None}
-        ],
-        "answer": "A",
-        "images": f"output/images/{filename}"
-    }
-    questions.append(question)
-
-with open("output/generated_questions.json", "w", encoding="utf-8") as f:
-    json.dump(questions, f, indent=2, ensure_ascii=False)
-
-print("✅ Questions saved to: output/generated_questions.json")
+try:
+    import orjson  # Faster JSON encoding/decoding when installed
+except ImportError:
+    orjson = None
+
+CAPTIONS_PATH = "output/image_captions.json"
+QUESTIONS_OUTPUT = "output/generated_questions.json"
+
+def save_captions(captions: dict) -> None:
+    # Save image captions to JSON (written even when empty so it matches the questions file)
+    with open(CAPTIONS_PATH, "w") as f:
+        json.dump(captions, f, indent=2)
+
+    print(f"✅ Captions saved to {CAPTIONS_PATH}")
+
+def build_questions(captions: dict) -> None:
+    questions = []
+
+    for filename, caption in captions.items():
+        question = {
+            "question": f"What does this image likely represent?",
+            "options": [
+                {"label": "A", "text": caption, "image": None},
+                {"label": "B", "text": "A random object", "image": None},
+                {"label": "C", "text": "An unrelated thing", "image": None},
+                {"label": "D", "text": "None of the above", "image": None}
+            ],
+            "answer": "A",
+            "images": f"output/images/{filename}"
+        }
+        questions.append(question)
+
+    if orjson:
+        with open(QUESTIONS_OUTPUT, "wb") as f:
+            f.write(orjson.dumps(questions, option=orjson.OPT_INDENT_2))
+    else:
+        with open(QUESTIONS_OUTPUT, "w", encoding="utf-8") as f:
+            json.dump(questions, f, indent=2, ensure_ascii=False)
+
+    print(f"✅ Questions saved to: {QUESTIONS_OUTPUT}")
+
+if __name__ == "__main__":
+    # Standalone mode: read captions written by generate_image_captions.py
+    with open(CAPTIONS_PATH, "rb") as f:
+        data = f.read()
+    captions = orjson.loads(data) if orjson else json.loads(data)
+    build_questions(captions)